@@ -3,7 +3,7 @@
 
 install_packages()
 {
-    PKGLIST="python3-dev curl"
+    PKGLIST="python3-dev"
 
     # Update system package info
     report_status "Running apt-get update..."
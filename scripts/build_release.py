@@ -4,8 +4,6 @@
 import os
 import sys
 import argparse
-import shutil
-import tempfile
 import json
 import pathlib
 import time
@@ -13,7 +11,17 @@ import traceback
 import subprocess
 import re
 import hashlib
-from typing import Dict, Any, List, Set, Optional
+import http.client
+import urllib.parse
+import itertools
+import mmap
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import (
+    Dict, Any, List, Set, Optional, Iterator, Tuple, Deque, FrozenSet,
+    Pattern, Sequence
+)
 
 # Path to the application root
 APP_PATH = os.path.abspath(
@@ -24,9 +32,15 @@ APP_PATH = os.path.abspath(
 IGNORE_DIRS = ["__pycache__"]
 IGNORE_EXTS = [".o", ".so", ".pyc", ".pyo", ".pyd", ".yml", ".yaml"]
 
+# Extensions of already compressed files.  These are stored in the source
+# package without compression.
+STORED_EXTS = frozenset([".png", ".gif", ".jpg", ".jpeg", ".zip", ".gz"])
+
 # Files not to include in the source package
-SKIP_FILES = [".gitignore", ".gitattributes", ".readthedocs.yaml",
-              "mkdocs.yml", "__pycache__"]
+SKIP_FILES = frozenset([
+    ".gitignore", ".gitattributes", ".readthedocs.yaml", "mkdocs.yml",
+    "__pycache__"
+])
 
 # The GitHub API url for current releases in this repo
 RELEASE_URL = "https://api.github.com/repos/Arksine/moontest/releases"
@@ -53,24 +67,107 @@ INSTALL_SCRIPTS = {}
 #    }
 #}
 
+# Patterns used to parse package lists from install scripts
+PKGLIST_RE = re.compile(r'PKGLIST="(.*)"')
+AURLIST_RE = re.compile(r'AURLIST="(.*)"')
+
 # Helpers for generating the COMMIT_LOG
 GIT_MAX_LOG_CNT = 100
 GIT_LOG_FMT = \
     "sha:%H%x1Dauthor:%an%x1Ddate:%ct%x1Dsubject:%s%x1Dmessage:%b%x1E"
 
-# Parse the git version from the command line.  This code
-# is borrowed from Klipper.
-def retreive_git_version(source_path: str) -> str:
-    # Obtain version info from "git" program
-    prog = ('git', '-C', source_path, 'describe', '--always',
-            '--tags', '--long', '--dirty')
-    process = subprocess.Popen(prog, stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    ver, err = process.communicate()
-    retcode = process.wait()
-    if retcode == 0:
-        return ver.strip().decode()
-    raise Exception(f"Failed to retreive git version: {err.decode()}")
+def _run(args: Sequence[str],
+         cwd: Optional[str] = None
+         ) -> Tuple[int, bytes, bytes]:
+    proc = subprocess.run(args, cwd=cwd, capture_output=True, check=False)
+    return proc.returncode, proc.stdout, proc.stderr
+
+# Parse the git version and commit hash from the command line.  The
+# version parsing is borrowed from Klipper.
+def retreive_git_info(source_path: str) -> Tuple[str, str]:
+    # Obtain version info and the HEAD commit from the "git" program
+    progs = (
+        ('git', '-C', source_path, 'describe', '--always',
+         '--tags', '--long', '--dirty'),
+        ('git', '-C', source_path, 'rev-parse', '--verify', 'HEAD')
+    )
+    results: List[str] = []
+    for prog in progs:
+        retcode, output, err = _run(prog)
+        if retcode != 0:
+            raise Exception(f"Failed to retreive git info: {err.decode()}")
+        results.append(output.strip().decode())
+    return results[0], results[1]
+
+# Walk a directory tree using os.scandir, yielding each directory path
+# along with its sorted list of file entries.  Directories are visited
+# in the same (sorted, top-down) order as os.walk so that the resulting
+# hash is deterministic.  Symlinked directories are not descended into.
+def _walk_scandir(root: str,
+                  ignore_dirs: FrozenSet[str],
+                  ignore_exts: FrozenSet[str]
+                  ) -> Iterator[Tuple[str, List[os.DirEntry]]]:
+    stack: List[str] = [root]
+    while stack:
+        dpath = stack.pop()
+        dirs: List[os.DirEntry] = []
+        files: List[os.DirEntry] = []
+        # Filter entries while iterating the directory, then sort only
+        # the entries that remain
+        try:
+            with os.scandir(dpath) as it:
+                for entry in it:
+                    name = entry.name
+                    if name[0] == '.':
+                        continue
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if name not in ignore_dirs and not entry.is_symlink():
+                            dirs.append(entry)
+                        continue
+                    dot = name.rfind('.')
+                    ext = name[dot:].lower() if dot >= 0 else ""
+                    if ext not in ignore_exts:
+                        files.append(entry)
+        except OSError:
+            continue
+        files.sort(key=lambda e: e.name)
+        yield dpath, files
+        # Push in reverse order so the first sorted dir is popped next
+        dirs.sort(key=lambda e: e.name, reverse=True)
+        stack.extend(d.path for d in dirs)
+
+# Files larger than this are streamed through a shared buffer rather
+# than read into memory in full
+HASH_CHUNK_SIZE = 1 << 20
+# Files larger than this are memory mapped and hashed without copying
+HASH_MMAP_SIZE = 16 << 20
+
+def _read_source_file(fpath: str) -> Optional[bytes]:
+    try:
+        if os.path.getsize(fpath) > HASH_CHUNK_SIZE:
+            return None
+        return pathlib.Path(fpath).read_bytes()
+    except Exception:
+        return None
+
+def _stream_source_file(checksum: Any, fpath: str, view: memoryview) -> None:
+    try:
+        with open(fpath, "rb", buffering=0) as f:
+            if os.fstat(f.fileno()).st_size > HASH_MMAP_SIZE:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    checksum.update(mm)
+                return
+            while True:
+                count = f.readinto(view)
+                if not count:
+                    break
+                checksum.update(view[:count])
+    except Exception:
+        pass
 
 # Method to recursively calculate the hash of a directory
 def hash_directory(dir_path: str,
@@ -80,52 +177,65 @@ def hash_directory(dir_path: str,
     checksum = hashlib.blake2s()
     if not os.path.exists(dir_path):
         return ""
-    for dpath, dnames, fnames in os.walk(dir_path):
-        valid_dirs: List[str] = []
-        for dname in sorted(dnames):
-            if dname[0] == '.' or dname in ignore_dirs:
-                continue
-            valid_dirs.append(dname)
-        dnames[:] = valid_dirs
-        for fname in sorted(fnames):
-            ext = os.path.splitext(fname)[-1].lower()
-            if fname[0] == '.' or ext in ignore_exts:
-                continue
-            fpath = pathlib.Path(os.path.join(dpath, fname))
-            try:
-                checksum.update(fpath.read_bytes())
-            except Exception:
-                pass
+    exts = frozenset(ext.lower() for ext in ignore_exts)
+    dirs = frozenset(ignore_dirs)
+    # Collect the file list up front so the hash order is deterministic
+    file_paths: Iterator[str] = iter([
+        entry.path for _, file_entries in _walk_scandir(dir_path, dirs, exts)
+        for entry in file_entries
+    ])
+    # Small files are read ahead of the hasher by a pool of threads,
+    # large files are streamed in the main thread.  The checksum is
+    # always updated in order.  The checksum format is shared with
+    # Moonraker, so the hash itself must remain serial.
+    view = memoryview(bytearray(HASH_CHUNK_SIZE))
+    max_workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending: Deque[Tuple[str, Future]] = deque(
+            (fpath, executor.submit(_read_source_file, fpath))
+            for fpath in itertools.islice(file_paths, max_workers * 2)
+        )
+        while pending:
+            fpath, fut = pending.popleft()
+            data: Optional[bytes] = fut.result()
+            next_path = next(file_paths, None)
+            if next_path is not None:
+                pending.append(
+                    (next_path, executor.submit(_read_source_file, next_path))
+                )
+            if data is None:
+                _stream_source_file(checksum, fpath, view)
+            else:
+                checksum.update(data)
     return checksum.hexdigest()
 
 class CopyIgnore:
     def __init__(self, root_dir: str) -> None:
         self.root_dir = root_dir
+        # Ignore all hidden directories in the root
+        with os.scandir(root_dir) as it:
+            self.hidden_root_dirs: Set[str] = {
+                entry.name for entry in it
+                if entry.name[0] == "." and entry.is_dir()
+            }
 
     def __call__(self, dir_path: str, dir_items: List[str]) -> List[str]:
         ignored: List[str] = []
         for item in dir_items:
             if item in SKIP_FILES:
                 ignored.append(item)
-            elif dir_path == self.root_dir:
-                full_path = os.path.join(dir_path, item)
-                # Ignore all hidden directories in the root
-                if os.path.isdir(full_path) and item[0] == ".":
-                    ignored.append(item)
+            elif dir_path == self.root_dir and item in self.hidden_root_dirs:
+                ignored.append(item)
         return ignored
 
 def search_install_script(data: str,
-                          regex: str,
+                          pattern: Pattern[str],
                           exclude: str
                           ) -> List[str]:
-    items: Set[str] = set()
-    lines: List[str] = re.findall(regex, data)
-    for line in lines:
-        items.update(line.strip().split())
-    try:
-        items.remove(exclude)
-    except KeyError:
-        pass
+    items: Set[str] = {
+        item for line in pattern.findall(data)
+        for item in line.split() if item != exclude
+    }
     return list(items)
 
 def generate_dependency_info(repo_path: str, app_name: str) -> None:
@@ -141,28 +251,30 @@ def generate_dependency_info(repo_path: str, app_name: str) -> None:
             continue
         data = script.read_text()
         packages: List[str] = search_install_script(
-            data, r'PKGLIST="(.*)"', "${PKGLIST}")
+            data, PKGLIST_RE, "${PKGLIST}")
         package_info[distro] = {'packages': sorted(packages)}
         if distro == "arch":
             aur_packages: List[str] = search_install_script(
-                data, r'AURLIST="(.*)"', "${AURLIST}")
+                data, AURLIST_RE, "${AURLIST}")
             package_info[distro]['aur_packages'] = sorted(aur_packages)
     req_file_name = os.path.join(repo_path, "scripts",
                                  f"{app_name}-requirements.txt")
     req_file = pathlib.Path(req_file_name)
-    if req_file.exists():
+    try:
+        req_data = req_file.read_text()
+    except FileNotFoundError:
+        pass
+    else:
         python_reqs: List[str] = []
-        if req_file.exists():
-            req_data = req_file.read_text()
-            lines = [line.strip() for line in req_data.split('\n')
-                    if line.strip()]
-            for line in lines:
-                comment_idx = line.find('#')
-                if comment_idx == 0:
-                    continue
-                if comment_idx > 0:
-                    line = line[:comment_idx].strip()
-                python_reqs.append(line)
+        lines = [line.strip() for line in req_data.split('\n')
+                 if line.strip()]
+        for line in lines:
+            comment_idx = line.find('#')
+            if comment_idx == 0:
+                continue
+            if comment_idx > 0:
+                line = line[:comment_idx].strip()
+            python_reqs.append(line)
         package_info['python'] = sorted(python_reqs)
     dep_file = pathlib.Path(os.path.join(repo_path, ".dependencies"))
     dep_file.write_text(json.dumps(package_info))
@@ -170,23 +282,55 @@ def generate_dependency_info(repo_path: str, app_name: str) -> None:
 def clean_repo(path: str) -> None:
     # Obtain version info from "git" program
     prog = ('git', '-C', path, 'clean', '-x', '-f', '-d')
-    process = subprocess.Popen(prog, stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE, cwd=path)
-    retcode = process.wait()
+    retcode, _, _ = _run(prog, cwd=path)
     if retcode != 0:
         print(f"Error running git clean: {path}")
 
+# Persistent HTTPS connections, keyed by host
+HTTP_CONNECTIONS: Dict[str, http.client.HTTPSConnection] = {}
+
+def http_get(url: str,
+             headers: Dict[str, str],
+             max_redirects: int = 5
+             ) -> Tuple[int, bytes]:
+    for _ in range(max_redirects + 1):
+        parsed = urllib.parse.urlparse(url)
+        conn = HTTP_CONNECTIONS.get(parsed.netloc)
+        if conn is None:
+            conn = http.client.HTTPSConnection(parsed.netloc, timeout=30.)
+            HTTP_CONNECTIONS[parsed.netloc] = conn
+        path = parsed.path or "/"
+        if parsed.query:
+            path = f"{path}?{parsed.query}"
+        req_headers = {"User-Agent": "moontest-build-release"}
+        req_headers.update(headers)
+        try:
+            conn.request("GET", path, headers=req_headers)
+            resp = conn.getresponse()
+            body = resp.read()
+        except Exception:
+            # Drop the connection so the next request opens a new one
+            conn.close()
+            del HTTP_CONNECTIONS[parsed.netloc]
+            raise
+        location = resp.getheader("Location")
+        if resp.status in (301, 302, 303, 307, 308) and location:
+            url = urllib.parse.urljoin(url, location)
+            continue
+        return resp.status, body
+    raise Exception(f"Too many redirects: {url}")
+
 def get_releases() -> List[Dict[str, Any]]:
     print("Fetching Release List...")
-    prog = ('curl', '-H', "Accept: application/vnd.github.v3+json",
-            RELEASE_URL)
-    process = subprocess.Popen(prog, stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    response, err = process.communicate()
-    retcode = process.wait()
-    if retcode != 0:
-        print(f"Release list request returned with code {retcode},"
-              f" response:\n{err.decode()}")
+    try:
+        status, response = http_get(
+            RELEASE_URL, {"Accept": "application/vnd.github.v3+json"})
+    except Exception as e:
+        print(f"Release list request failed: {e}")
+        return []
+    if status != 200:
+        print(f"Release list request returned with code {status},"
+              f" response:\n{response.decode()}")
         return []
     releases = json.loads(response.decode().strip())
     print(f"Found {len(releases)} releases")
@@ -237,12 +381,11 @@ def get_last_release_info(repo_version: str,
         return {}
         # This build is prior to a tagged release, so fetch the current tag
     print(f"Release Info Download URL: {asset_url}")
-    prog = ('curl', '-L', '-H', f"Accept: {content_type}", asset_url)
-    process = subprocess.Popen(prog, stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    response, err = process.communicate()
-    retcode = process.wait()
-    if retcode != 0:
+    try:
+        status, response = http_get(asset_url, {"Accept": content_type})
+    except Exception:
+        status = 0
+    if status != 200:
         print("Request for release info failed")
         return {}
     resp = response.decode().strip()
@@ -259,46 +402,38 @@ def get_commit_log(path: str,
     if start_sha is not None:
         prog = ['git', '-C', path, 'log', f'{start_sha}..HEAD',
                 f'--format={GIT_LOG_FMT}', f'--max-count={GIT_MAX_LOG_CNT}']
-    process = subprocess.Popen(prog, stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE, cwd=path)
-    response, err = process.communicate()
-    retcode = process.wait()
+    retcode, response, _ = _run(prog, cwd=path)
     if retcode != 0:
         return []
-    resp = response.decode().strip()
     commit_log: List[Dict[str, Any]] = []
-    for log_entry in resp.split('\x1E'):
-        log_entry = log_entry.strip()
-        if not log_entry:
-            continue
-        log_items = [li.strip() for li in log_entry.split('\x1D')
-                     if li.strip()]
-        cbh = [li.split(':', 1) for li in log_items]
-        commit_log.append(dict(cbh))  # type: ignore
+    for log_entry in response.split(b'\x1E'):
+        commit_info: Dict[str, Any] = {}
+        for field in log_entry.split(b'\x1D'):
+            field = field.strip()
+            if not field:
+                continue
+            key, _, value = field.partition(b':')
+            commit_info[key.decode()] = value.decode()
+        if commit_info:
+            commit_log.append(commit_info)
     print(f"Found {len(commit_log)} commits")
     return commit_log
 
-def get_commit_hash(path: str) -> str:
-    prog = ('git', '-C', path, 'rev-parse', 'HEAD')
-    process = subprocess.Popen(prog, stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE, cwd=path)
-    commit_hash, err = process.communicate()
-    retcode = process.wait()
-    if retcode == 0:
-        return commit_hash.strip().decode()
-    raise Exception(f"Failed to get commit hash: {commit_hash.decode()}")
-
 def generate_version_info(path: str,
                           app_name: str,
                           channel: str,
                           release_tag: Optional[str] = None
                           ) -> Dict[str, Any]:
     print(f"Generating version info: {app_name}")
-    clean_repo(path)
     owner_repo = OWNER_REPOS[app_name]
     curtime = int(time.time())
     date_str = time.strftime("%Y%m%d", time.gmtime(curtime))
-    version = retreive_git_version(path)
+    # "git clean" only removes untracked files, so it may safely run
+    # alongside the version queries
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        clean_fut = executor.submit(clean_repo, path)
+        version, commit_hash = retreive_git_info(path)
+        clean_fut.result()
     if release_tag is None:
         release_tag = version.split('-')[0]
     source_hash = hash_directory(path, IGNORE_EXTS, IGNORE_DIRS)
@@ -306,7 +441,7 @@ def generate_version_info(path: str,
     release_info = {
         'git_version': version,
         'long_version': long_version,
-        'commit_hash': get_commit_hash(path),
+        'commit_hash': commit_hash,
         'source_checksum': source_hash,
         'ignored_exts': IGNORE_EXTS,
         'ignored_dirs': IGNORE_DIRS,
@@ -321,17 +456,36 @@ def generate_version_info(path: str,
     generate_dependency_info(path, app_name)
     return release_info
 
+def _zip_directory(zip_file: zipfile.ZipFile,
+                   dir_path: str,
+                   arc_path: str,
+                   ignore_cb: CopyIgnore
+                   ) -> None:
+    with os.scandir(dir_path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    ignored = set(ignore_cb(dir_path, [e.name for e in entries]))
+    for entry in entries:
+        if entry.name in ignored:
+            continue
+        arcname = f"{arc_path}/{entry.name}" if arc_path else entry.name
+        ext = os.path.splitext(entry.name)[1].lower()
+        if ext in STORED_EXTS:
+            zip_file.write(entry.path, arcname, zipfile.ZIP_STORED)
+        else:
+            zip_file.write(entry.path, arcname)
+        if entry.is_dir():
+            _zip_directory(zip_file, entry.path, arcname, ignore_cb)
+
 def create_zip(repo_path: str,
                repo_name: str,
                output_path: str
                ) -> None:
     print(f"Creating Zip Release: {repo_name}")
-    zip_path = os.path.join(output_path, repo_name)
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        dest_path = os.path.join(tmp_dir, repo_name)
-        ingore_cb = CopyIgnore(repo_path)
-        shutil.copytree(repo_path, dest_path, ignore=ingore_cb)
-        shutil.make_archive(zip_path, "zip", root_dir=dest_path)
+    zip_path = os.path.join(output_path, f"{repo_name}.zip")
+    ignore_cb = CopyIgnore(repo_path)
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED,
+                         compresslevel=6) as zip_file:
+        _zip_directory(zip_file, repo_path, "", ignore_cb)
 
 def main() -> None:
     # Parse start arguments
@@ -350,7 +504,10 @@ def main() -> None:
     if not os.path.exists(opath):
         print(f"Invalid output path: {opath}")
         sys.exit(-1)
-    releases = get_releases()
+    # Fetch the release list in the background while the local build runs
+    executor = ThreadPoolExecutor(max_workers=1)
+    releases_fut: Future = executor.submit(get_releases)
+    executor.shutdown(wait=False)
     all_info: Dict[str, Dict[str, Any]] = {}
     try:
         print("Generating moontest Zip Distribution...")
@@ -360,7 +517,8 @@ def main() -> None:
         info_file = pathlib.Path(os.path.join(opath, "RELEASE_INFO"))
         info_file.write_text(json.dumps(all_info))
         last_rinfo = get_last_release_info(
-            all_info['moontest']['git_version'], is_beta, releases)
+            all_info['moontest']['git_version'], is_beta,
+            releases_fut.result())
         commit_log = {}
         commit_log['moontest'] = get_commit_log(
             APP_PATH, last_rinfo.get('moontest', {}))